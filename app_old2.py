@@ -19,7 +19,7 @@ Render Start Command:
   uvicorn app:app --host 0.0.0.0 --port $PORT
 
 Local Run:
-  pip install fastapi uvicorn[standard] sqlalchemy psycopg[binary] python-dotenv requests
+  pip install fastapi uvicorn[standard] sqlalchemy psycopg[binary] python-dotenv httpx[http2] orjson jinja2
   uvicorn app:app --reload --port 8000
 
 ENV (.env):
@@ -27,28 +27,37 @@ ENV (.env):
   WHATSAPP_TOKEN=EAA...
   WHATSAPP_PHONE_NUMBER_ID=123456789012345
   WHATSAPP_VERIFY_TOKEN=nxmx_verify_token
+  APP_SECRET=meta_app_secret   (optional; verifies webhook signatures)
   ADMIN_TOKEN=change_me_strong_token
   DEFAULT_TENANT_ID=1
 """
 
 import os
+import hashlib
+import hmac
 import json
+import queue
+import re
+import threading
+import time
 import datetime as dt
 from typing import Dict, Set, Optional, Tuple
 
-import requests
-from fastapi import FastAPI, Request, Depends, HTTPException, Form
+import httpx
+import orjson
+from fastapi import FastAPI, Request, Depends, HTTPException, Form, BackgroundTasks
 from fastapi.responses import HTMLResponse, RedirectResponse, PlainTextResponse
 from dotenv import load_dotenv
+from jinja2 import Template
 
 from sqlalchemy import (
-    create_engine, String, Integer, Boolean, DateTime, ForeignKey, Text, func, select
+    bindparam, create_engine, event, Index, String, Integer, Boolean, DateTime, ForeignKey, Text, func, insert, select, text, update
 )
 from sqlalchemy.orm import (
     DeclarativeBase, Mapped, mapped_column, relationship, sessionmaker, Session
 )
 
-from fastapi.responses import HTMLResponse, RedirectResponse, PlainTextResponse, Response
+from fastapi.responses import HTMLResponse, ORJSONResponse, RedirectResponse, PlainTextResponse, Response
 
 # --------------------------
 # Config
@@ -60,6 +69,7 @@ WHATSAPP_TOKEN = os.getenv("WHATSAPP_TOKEN", "")
 WHATSAPP_PHONE_NUMBER_ID = os.getenv("PHONE_NUMBER_ID", "")
 WHATSAPP_VERIFY_TOKEN = os.getenv("VERIFY_TOKEN", "")
 ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "change_me")
+WHATSAPP_APP_SECRET = os.getenv("APP_SECRET", "")  # enables X-Hub-Signature-256 checks when set
 DEFAULT_TENANT_ID = int(os.getenv("DEFAULT_TENANT_ID", "1"))
 
 GRAPH_URL = "https://graph.facebook.com/v20.0"
@@ -105,11 +115,37 @@ def allowed_features(plan: str) -> Set[str]:
 # DB setup
 # --------------------------
 connect_args = {}
+pool_args = {}
 if DATABASE_URL.startswith("sqlite"):
     connect_args = {"check_same_thread": False}
+else:
+    pool_args = {"pool_size": 20, "max_overflow": 10, "pool_timeout": 10, "pool_recycle": 1800}
 
-engine = create_engine(DATABASE_URL, connect_args=connect_args, pool_pre_ping=True)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+engine = create_engine(
+    DATABASE_URL, connect_args=connect_args, pool_pre_ping=True, query_cache_size=1200, **pool_args
+)
+
+if DATABASE_URL.startswith("sqlite"):
+    @event.listens_for(engine, "connect")
+    def _sqlite_pragmas(dbapi_conn, _conn_record):
+        # WAL lets webhook reads run alongside writes; NORMAL sync avoids an fsync per commit
+        cur = dbapi_conn.cursor()
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        cur.execute("PRAGMA temp_store=MEMORY")
+        cur.execute("PRAGMA cache_size=-64000")
+        cur.execute("PRAGMA mmap_size=134217728")
+        cur.close()
+
+if engine.dialect.name == "sqlite":
+    from sqlalchemy.dialects.sqlite import insert as upsert_insert
+elif engine.dialect.name == "postgresql":
+    from sqlalchemy.dialects.postgresql import insert as upsert_insert
+else:
+    upsert_insert = None
+
+# expire_on_commit=False: objects stay usable after commit without a reload SELECT
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
 
 
 class Base(DeclarativeBase):
@@ -137,6 +173,10 @@ class FeatureFlag(Base):
     tenant: Mapped["Tenant"] = relationship(back_populates="flags")
 
 
+# One row per (tenant, flag): single B-tree probe for lookups and the conflict target for set_flag's upsert
+uq_ff_tenant_flag = Index("uq_ff_tenant_flag", FeatureFlag.tenant_id, FeatureFlag.flag_key, unique=True)
+
+
 class Client(Base):
     __tablename__ = "clients"
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
@@ -159,6 +199,21 @@ class MessageLog(Base):
     created_at: Mapped[dt.datetime] = mapped_column(DateTime, server_default=func.now())
 
 
+# Serves the dashboard's per-tenant COUNT / MAX(created_at) from the index alone
+ix_message_logs_tenant_created = Index(
+    "ix_message_logs_tenant_created", MessageLog.tenant_id, MessageLog.created_at.desc()
+)
+
+
+# Reused statements: bound parameters keep the compiled-cache key identical across calls
+_FLAG_KEYS_BY_TENANT = select(FeatureFlag.flag_key).where(FeatureFlag.tenant_id == bindparam("tid"))
+_FLAGS_BY_TENANT = select(FeatureFlag).where(FeatureFlag.tenant_id == bindparam("tid"))
+_FLAG_ENABLED = select(FeatureFlag.enabled).where(
+    FeatureFlag.tenant_id == bindparam("tid"), FeatureFlag.flag_key == bindparam("key")
+)
+_TENANTS_ORDERED = select(Tenant).order_by(Tenant.id.asc())
+
+
 def get_db():
     db = SessionLocal()
     try:
@@ -169,6 +224,25 @@ def get_db():
 
 def init_db():
     Base.metadata.create_all(bind=engine)
+    # create_all skips tables that already exist, so add the indexes on older databases too
+    ix_message_logs_tenant_created.create(bind=engine, checkfirst=True)
+    uq_ff_tenant_flag.create(bind=engine, checkfirst=True)
+
+
+def warm_pool():
+    # Check out a few connections up front so the first webhooks don't pay connect latency
+    n = min(pool_args.get("pool_size", 1), 5)
+    conns = [engine.connect() for _ in range(n)]
+    for c in conns:
+        c.execute(text("SELECT 1"))
+    for c in conns:
+        c.close()
+
+
+# Dashboard guards: tenants whose default flags were seeded by this process,
+# and the plan each tenant was last enforced against.
+_SEEDED: Set[int] = set()
+_ENFORCED_PLAN: Dict[int, str] = {}
 
 
 def ensure_default_tenant(db: Session, tenant_id: int = 1) -> Tenant:
@@ -179,37 +253,57 @@ def ensure_default_tenant(db: Session, tenant_id: int = 1) -> Tenant:
         db.commit()
         db.refresh(tenant)
 
-    existing = set(db.scalars(select(FeatureFlag.flag_key).where(FeatureFlag.tenant_id == tenant.id)).all())
-    for k, v in DEFAULT_FLAGS_ON.items():
-        if k not in existing:
-            db.add(FeatureFlag(tenant_id=tenant.id, flag_key=k, enabled=bool(v)))
-    db.commit()
+    existing = set(db.scalars(_FLAG_KEYS_BY_TENANT, {"tid": tenant.id}).all())
+    missing = [
+        {"tenant_id": tenant.id, "flag_key": k, "enabled": bool(v)}
+        for k, v in DEFAULT_FLAGS_ON.items()
+        if k not in existing
+    ]
+    if missing:
+        stmt = insert(FeatureFlag)
+        if upsert_insert is not None:
+            # Workers seeding at the same boot race on uq_ff_tenant_flag; the loser just skips the row
+            stmt = upsert_insert(FeatureFlag).on_conflict_do_nothing(
+                index_elements=[FeatureFlag.tenant_id, FeatureFlag.flag_key]
+            )
+        db.execute(stmt, missing)
+        db.commit()
+    _SEEDED.add(tenant.id)
     return tenant
 
 
 def get_flags(db: Session, tenant_id: int) -> Dict[str, bool]:
-    rows = db.scalars(select(FeatureFlag).where(FeatureFlag.tenant_id == tenant_id)).all()
+    rows = db.scalars(_FLAGS_BY_TENANT, {"tid": tenant_id}).all()
     return {r.flag_key: bool(r.enabled) for r in rows}
 
 
-def set_flag(db: Session, tenant_id: int, flag_key: str, enabled: bool) -> FeatureFlag:
-    row = db.scalar(select(FeatureFlag).where(FeatureFlag.tenant_id == tenant_id, FeatureFlag.flag_key == flag_key))
-    if not row:
-        row = FeatureFlag(tenant_id=tenant_id, flag_key=flag_key, enabled=enabled)
-        db.add(row)
+def set_flag(db: Session, tenant_id: int, flag_key: str, enabled: bool) -> bool:
+    if upsert_insert is not None:
+        stmt = upsert_insert(FeatureFlag).values(tenant_id=tenant_id, flag_key=flag_key, enabled=enabled)
+        db.execute(stmt.on_conflict_do_update(
+            index_elements=[FeatureFlag.tenant_id, FeatureFlag.flag_key],
+            set_={"enabled": stmt.excluded.enabled},
+        ))
     else:
-        row.enabled = enabled
+        # No native upsert: toggling an existing flag is still a single UPDATE
+        res = db.execute(
+            update(FeatureFlag)
+            .where(FeatureFlag.tenant_id == tenant_id, FeatureFlag.flag_key == flag_key)
+            .values(enabled=enabled)
+        )
+        if res.rowcount == 0:
+            db.execute(insert(FeatureFlag), [{"tenant_id": tenant_id, "flag_key": flag_key, "enabled": enabled}])
     db.commit()
-    db.refresh(row)
-    return row
+    return enabled
 
 
 def enforce_plan(db: Session, tenant_id: int) -> Dict[str, bool]:
     tenant = db.get(Tenant, tenant_id)
     if not tenant:
         return {}
-    allow = allowed_features(tenant.plan)
-    rows = db.scalars(select(FeatureFlag).where(FeatureFlag.tenant_id == tenant_id)).all()
+    plan = tenant.plan
+    allow = allowed_features(plan)
+    rows = db.scalars(_FLAGS_BY_TENANT, {"tid": tenant_id}).all()
     changed = False
     for r in rows:
         if r.enabled and r.flag_key not in allow:
@@ -217,23 +311,97 @@ def enforce_plan(db: Session, tenant_id: int) -> Dict[str, bool]:
             changed = True
     if changed:
         db.commit()
+    _ENFORCED_PLAN[tenant_id] = plan
     return {r.flag_key: bool(r.enabled) for r in rows}
 
 
+# Per-process cache of (plan, effective flags) keyed by tenant_id.
+# Only the /admin/* endpoints change these, and they invalidate it after commit.
+_TENANT_CACHE: Dict[int, Tuple[str, Dict[str, bool]]] = {}
+
+
+def _get_tenant_state(db: Session, tenant_id: int) -> Tuple[str, Dict[str, bool]]:
+    state = _TENANT_CACHE.get(tenant_id)
+    if state is None:
+        tenant = db.get(Tenant, tenant_id)
+        flags = get_flags(db, tenant_id)
+        state = (tenant.plan if tenant else "starter", flags)
+        _TENANT_CACHE[tenant_id] = state
+    return state
+
+
 def is_enabled(db: Session, tenant_id: int, flag_key: str) -> bool:
-    row = db.scalar(select(FeatureFlag).where(FeatureFlag.tenant_id == tenant_id, FeatureFlag.flag_key == flag_key))
-    return bool(row.enabled) if row else False
-
-
-def log_message(db: Session, tenant_id: int, wa_from: str, wa_to: str, direction: str, message: str):
-    db.add(MessageLog(
-        tenant_id=tenant_id,
-        wa_from=wa_from,
-        wa_to=wa_to,
-        direction=direction,
-        message=message,
-    ))
-    db.commit()
+    return bool(db.scalar(_FLAG_ENABLED, {"tid": tenant_id, "key": flag_key}))
+
+
+# Message logs are written off the request path by a background thread,
+# batching whatever queued up within _LOG_FLUSH_SECS into one INSERT + COMMIT.
+_LOG_Q = queue.SimpleQueue()
+_LOG_BATCH_MAX = 500
+_LOG_FLUSH_SECS = 0.05
+_LOG_THREAD: Optional[threading.Thread] = None
+
+
+def log_message(tenant_id: int, wa_from: str, wa_to: str, direction: str, message: str):
+    _LOG_Q.put({
+        "tenant_id": tenant_id,
+        "wa_from": wa_from,
+        "wa_to": wa_to,
+        "direction": direction,
+        "message": message,
+    })
+
+
+def _write_log_batch(batch: list):
+    db = SessionLocal()
+    try:
+        db.execute(insert(MessageLog), batch)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print("[ERR] message log write failed:", str(e)[:200])
+    finally:
+        db.close()
+
+
+def _storage_worker():
+    while True:
+        item = _LOG_Q.get()
+        if item is None:
+            return
+        batch = [item]
+        stop = False
+        deadline = time.monotonic() + _LOG_FLUSH_SECS
+        while len(batch) < _LOG_BATCH_MAX:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = _LOG_Q.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                stop = True
+                break
+            batch.append(item)
+        _write_log_batch(batch)
+        if stop:
+            return
+
+
+def start_storage_worker():
+    global _LOG_THREAD
+    if _LOG_THREAD is None or not _LOG_THREAD.is_alive():
+        _LOG_THREAD = threading.Thread(target=_storage_worker, name="StorageWorker", daemon=True)
+        _LOG_THREAD.start()
+
+
+def stop_storage_worker():
+    global _LOG_THREAD
+    if _LOG_THREAD is not None:
+        _LOG_Q.put(None)  # sentinel: flush what's queued, then exit
+        _LOG_THREAD.join(timeout=5)
+        _LOG_THREAD = None
 
 
 # --------------------------
@@ -243,8 +411,20 @@ def wa_headers():
     return {"Authorization": f"Bearer {WHATSAPP_TOKEN}", "Content-Type": "application/json"}
 
 
-import requests
-import os
+# Shared outbound client: keeps TLS connections to Exotel / Graph alive across messages.
+_HTTP: Optional[httpx.AsyncClient] = None
+
+
+def http_client() -> httpx.AsyncClient:
+    global _HTTP
+    if _HTTP is None:
+        _HTTP = httpx.AsyncClient(
+            http2=True,
+            timeout=20,
+            limits=httpx.Limits(max_keepalive_connections=20),
+        )
+    return _HTTP
+
 
 async def send_text(to_number: str, text: str):
 
@@ -271,7 +451,7 @@ async def send_text(to_number: str, text: str):
 
     print("[DBG] EXOTEL SENDING:", payload)
 
-    r = requests.post(
+    r = await http_client().post(
         url,
         json=payload,
         auth=(exo_api_key, exo_api_token)
@@ -280,7 +460,7 @@ async def send_text(to_number: str, text: str):
     print("[DBG] EXOTEL RESPONSE:", r.status_code, r.text)
 
 
-def send_menu(to: str, menu_payload: dict):
+async def send_menu(to: str, menu_payload: dict):
     if not WHATSAPP_TOKEN or not WHATSAPP_PHONE_NUMBER_ID:
         return {"skipped": True, "reason": "Missing WHATSAPP_TOKEN/WHATSAPP_PHONE_NUMBER_ID", "to": to, "menu": menu_payload}
 
@@ -291,8 +471,11 @@ def send_menu(to: str, menu_payload: dict):
         print('[DBG] SENDING TO:', to)
     except Exception as _e:
         print('[DBG] send log error:', _e)
-    payload = {"messaging_product": "whatsapp", "to": to, **menu_payload}
-    r = requests.post(url, headers=wa_headers(), json=payload, timeout=20)
+    if menu_payload is MENU_PAYLOAD:
+        r = await http_client().post(url, headers=wa_headers(), content=_menu_body(to))
+    else:
+        payload = {"messaging_product": "whatsapp", "to": to, **menu_payload}
+        r = await http_client().post(url, headers=wa_headers(), json=payload)
     r.raise_for_status()
     return r.json()
 
@@ -323,6 +506,58 @@ MENU_PAYLOAD = {
     }
 }
 
+# Menu intents: id -> (required flag, reply when enabled, reply when locked)
+_INTENTS: Dict[str, Tuple[str, str, str]] = {
+    "MARKET_BRIEF": (
+        F_MARKET_BRIEF,
+        "📌 Market Brief (demo)\n• NIFTY: -0.42%\n• BANKNIFTY: Weak\n• FII: Net sellers\n\n(Connect live data feed next)",
+        "🔒 Market Brief is not enabled on your plan.",
+    ),
+    "WHY_MARKET_MOVED": (
+        F_WHY_MARKET_MOVED,
+        "🧠 Why Market Moved (demo)\nOI unwinding + global yield move.\n(Connect news + derivatives feed next)",
+        "🔒 Why Market Moved is not enabled on your plan.",
+    ),
+    "RISK_ALERTS": (
+        F_RISK_RADAR,
+        "🔴 Risk Alerts (demo)\n• Client A: high margin usage\n• Client B: panic pattern\n(Connect client trades next)",
+        "🔒 Risk Radar is a Pro feature. Reply 'Upgrade' to enable.",
+    ),
+    "CALL_PRIORITY": (
+        F_CALL_PRIORITY,
+        "📞 Priority Calls (demo)\n1) Client X — drawdown\n2) Client Y — expiry risk\n3) Client Z — panic history",
+        "🔒 Call Priority is a Pro feature. Reply 'Upgrade' to enable.",
+    ),
+    "SEBI_ADVISORY": (
+        F_SEBI_ADVISORY,
+        "✅ Paste the message you want to rewrite in SEBI-safe language (demo).",
+        "🔒 SEBI Advisory Generator is not enabled on your plan.",
+    ),
+    "CLIENT_AI": (
+        F_CLIENT_AI,
+        "🤖 Client Query Assistant (demo)\nAsk like: 'Reliance ka kya karu?'\n(Connect portfolio + risk profile next)",
+        "🔒 Client Query Assistant is not enabled on your plan.",
+    ),
+    "CALL_SUMMARY": (
+        F_CALL_AI,
+        "📞 Call Summary (demo)\nEmotion: anxious\nRisky promises: none\nFollow-up: suggested",
+        "🔒 Call AI summaries are an Elite feature. Reply 'Upgrade' to enable.",
+    ),
+}
+
+_GREETINGS = frozenset({"hi", "hello", "menu", "start"})
+_SETTINGS_WORDS = frozenset({"settings", "upgrade"})
+# One regex pass over the lowered text instead of a substring scan per phrase
+_RISKY_WORDING = re.compile("|".join(re.escape(w) for w in ["guarantee", "sure", "100%", "fixed return"]))
+
+# MENU_PAYLOAD is static, so serialize it once; only the recipient is spliced in per send
+_MENU_INNER = json.dumps(MENU_PAYLOAD)[1:-1].encode()
+
+
+def _menu_body(to: str) -> bytes:
+    digits = "".join(ch for ch in to if ch.isdigit())
+    return b'{"messaging_product":"whatsapp","to":"' + digits.encode() + b'",' + _MENU_INNER + b"}"
+
 
 def parse_inbound(payload: dict) -> Tuple[Optional[str], Optional[str], Optional[str]]:
     entry = payload["entry"][0]["changes"][0]["value"]
@@ -348,15 +583,32 @@ def parse_inbound(payload: dict) -> Tuple[Optional[str], Optional[str], Optional
     return wa_from, wa_to, text_body
 
 
+async def read_json(request: Request) -> dict:
+    try:
+        return orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+
+
+def signature_ok(raw: bytes, header: Optional[str]) -> bool:
+    if not header or not header.startswith("sha256="):
+        return False
+    expected = hmac.new(WHATSAPP_APP_SECRET.encode(), raw, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, header[len("sha256="):])
+
+
 # --------------------------
 # App
 # --------------------------
-app = FastAPI(title="NxMx StockExec AI (single-file)", version="1.0.0")
+app = FastAPI(title="NxMx StockExec AI (single-file)", version="1.0.0", default_response_class=ORJSONResponse)
 
 
 @app.on_event("startup")
 def _startup():
     init_db()
+    warm_pool()
+    start_storage_worker()
+    http_client()
     # ---- DEBUG LOGS (do not remove) ----
     try:
         svc = os.getenv('RENDER_SERVICE_NAME') or os.getenv('RENDER_SERVICE_ID') or 'unknown'
@@ -371,9 +623,20 @@ def _startup():
     db = SessionLocal()
     try:
         ensure_default_tenant(db, DEFAULT_TENANT_ID)
+        for tid in db.scalars(select(Tenant.id)).all():
+            enforce_plan(db, tid)
     finally:
         db.close()
 
+
+@app.on_event("shutdown")
+async def _shutdown():
+    global _HTTP
+    stop_storage_worker()
+    if _HTTP is not None:
+        await _HTTP.aclose()
+        _HTTP = None
+
 @app.head("/")
 def head_root():
     return Response(status_code=200)
@@ -429,18 +692,17 @@ def terms():
 
 
 @app.api_route("/webhook/whatsapp", methods=["GET", "POST"])
-async def whatsapp_webhook(request: Request):
+async def whatsapp_webhook(request: Request, background_tasks: BackgroundTasks):
     if request.method == "GET":
         return {"status": "ok"}
 
-    payload = await request.json()
-
-    print("[DBG] FULL PAYLOAD:", payload)
+    payload = await read_json(request)
 
     # -----------------------------
     # EXOTEL PAYLOAD SUPPORT
     # -----------------------------
     if "whatsapp" in payload and "messages" in payload["whatsapp"]:
+        print("[DBG] FULL PAYLOAD:", payload)
         msg = payload["whatsapp"]["messages"][0]
 
         callback_type = msg.get("callback_type")
@@ -459,12 +721,22 @@ async def whatsapp_webhook(request: Request):
         return {"status": "ok"}
 
     # -----------------------------
-    # META FALLBACK (existing logic)
+    # META
     # -----------------------------
-    entry = payload.get("entry", [])
-    if entry:
-        print("[DBG] META PAYLOAD DETECTED")
+    # Meta signs its POSTs; reject forgeries before anything from the body is logged or acted on
+    if WHATSAPP_APP_SECRET and not signature_ok(await request.body(), request.headers.get("x-hub-signature-256")):
+        raise HTTPException(status_code=403, detail="Invalid signature")
+
+    # Status callbacks / read receipts carry no message: ack them without any DB work
+    try:
+        wa_from, wa_to, body = parse_inbound(payload)
+    except (KeyError, IndexError, TypeError, AttributeError):
+        return {"status": "ok"}
+    if not wa_from or not body:
+        return {"status": "ok"}
 
+    # Ack Meta immediately; the reply is built and sent after the response goes out
+    background_tasks.add_task(process_inbound, payload, wa_from, wa_to, body)
     return {"status": "ok"}
 
 
@@ -479,11 +751,14 @@ def wa_verify(request: Request):
     raise HTTPException(status_code=403, detail="Verification failed")
 
 
-@app.post("/webhook/whatsapp")
-async def wa_inbound(payload: dict, db: Session = Depends(get_db)):
+async def process_inbound(payload: dict, wa_from: str, wa_to: str, body: str):
     print("[DBG] FULL PAYLOAD:", json.dumps(payload, indent=2))
     tenant_id = DEFAULT_TENANT_ID
-    enforce_plan(db, tenant_id)  # pricing enforcement on every message
+    db = SessionLocal()
+    try:
+        plan, flags = _get_tenant_state(db, tenant_id)  # plan already enforced at startup / on admin writes
+    finally:
+        db.close()
 
     try:
         # ---- DEBUG LOGS (incoming webhook) ----
@@ -510,86 +785,38 @@ async def wa_inbound(payload: dict, db: Session = Depends(get_db)):
             except Exception as _e:
                 print('[DBG] status parse error:', _e)
         # ------------------------------------------
-        wa_from, wa_to, body = parse_inbound(payload)
-        if not wa_from or not body:
-            return {"ok": True}
-
-        if is_enabled(db, tenant_id, F_COMPLIANCE_LOG):
-            log_message(db, tenant_id, wa_from, wa_to or "", "inbound", body)
-
-        if body.lower() in {"hi", "hello", "menu", "start"}:
-            send_menu(wa_from, MENU_PAYLOAD)
-            if is_enabled(db, tenant_id, F_COMPLIANCE_LOG):
-                log_message(db, tenant_id, wa_from, wa_to or "", "outbound", "MENU_SENT")
-            return {"ok": True}
-
-        if body == "MARKET_BRIEF":
-            if not is_enabled(db, tenant_id, F_MARKET_BRIEF):
-                send_text(wa_from, "🔒 Market Brief is not enabled on your plan.")
-                return {"ok": True}
-            send_text(wa_from, "📌 Market Brief (demo)\n• NIFTY: -0.42%\n• BANKNIFTY: Weak\n• FII: Net sellers\n\n(Connect live data feed next)")
-            return {"ok": True}
-
-        if body == "WHY_MARKET_MOVED":
-            if not is_enabled(db, tenant_id, F_WHY_MARKET_MOVED):
-                send_text(wa_from, "🔒 Why Market Moved is not enabled on your plan.")
-                return {"ok": True}
-            send_text(wa_from, "🧠 Why Market Moved (demo)\nOI unwinding + global yield move.\n(Connect news + derivatives feed next)")
-            return {"ok": True}
-
-        if body == "RISK_ALERTS":
-            if not is_enabled(db, tenant_id, F_RISK_RADAR):
-                send_text(wa_from, "🔒 Risk Radar is a Pro feature. Reply 'Upgrade' to enable.")
-                return {"ok": True}
-            send_text(wa_from, "🔴 Risk Alerts (demo)\n• Client A: high margin usage\n• Client B: panic pattern\n(Connect client trades next)")
-            return {"ok": True}
-
-        if body == "CALL_PRIORITY":
-            if not is_enabled(db, tenant_id, F_CALL_PRIORITY):
-                send_text(wa_from, "🔒 Call Priority is a Pro feature. Reply 'Upgrade' to enable.")
-                return {"ok": True}
-            send_text(wa_from, "📞 Priority Calls (demo)\n1) Client X — drawdown\n2) Client Y — expiry risk\n3) Client Z — panic history")
-            return {"ok": True}
-
-        if body == "SEBI_ADVISORY":
-            if not is_enabled(db, tenant_id, F_SEBI_ADVISORY):
-                send_text(wa_from, "🔒 SEBI Advisory Generator is not enabled on your plan.")
-                return {"ok": True}
-            send_text(wa_from, "✅ Paste the message you want to rewrite in SEBI-safe language (demo).")
-            return {"ok": True}
-
-        if body == "CLIENT_AI":
-            if not is_enabled(db, tenant_id, F_CLIENT_AI):
-                send_text(wa_from, "🔒 Client Query Assistant is not enabled on your plan.")
-                return {"ok": True}
-            send_text(wa_from, "🤖 Client Query Assistant (demo)\nAsk like: 'Reliance ka kya karu?'\n(Connect portfolio + risk profile next)")
-            return {"ok": True}
-
-        if body == "CALL_SUMMARY":
-            if not is_enabled(db, tenant_id, F_CALL_AI):
-                send_text(wa_from, "🔒 Call AI summaries are an Elite feature. Reply 'Upgrade' to enable.")
-                return {"ok": True}
-            send_text(wa_from, "📞 Call Summary (demo)\nEmotion: anxious\nRisky promises: none\nFollow-up: suggested")
-            return {"ok": True}
-
-        if body == "SETTINGS" or body.lower() in {"settings", "upgrade"}:
-            t = db.get(Tenant, tenant_id)
-            flags = get_flags(db, tenant_id)
+        if flags.get(F_COMPLIANCE_LOG, False):
+            log_message(tenant_id, wa_from, wa_to or "", "inbound", body)
+
+        low = body.lower()
+        if low in _GREETINGS:
+            await send_menu(wa_from, MENU_PAYLOAD)
+            if flags.get(F_COMPLIANCE_LOG, False):
+                log_message(tenant_id, wa_from, wa_to or "", "outbound", "MENU_SENT")
+            return
+
+        intent = _INTENTS.get(body)
+        if intent:
+            flag, ok_txt, locked_txt = intent
+            await send_text(wa_from, ok_txt if flags.get(flag, False) else locked_txt)
+            return
+
+        if body == "SETTINGS" or low in _SETTINGS_WORDS:
             enabled = [k.replace("F_", "") for k, v in flags.items() if v]
-            send_text(wa_from, f"⚙️ Current Plan: {t.plan if t else 'starter'}\nEnabled: {', '.join(enabled) if enabled else '(none)'}\n\nAdmin can upgrade from dashboard.")
-            return {"ok": True}
+            await send_text(wa_from, f"⚙️ Current Plan: {plan}\nEnabled: {', '.join(enabled) if enabled else '(none)'}\n\nAdmin can upgrade from dashboard.")
+            return
 
         # Basic SEBI-safe rewrite demo if user pastes risky wording
-        if is_enabled(db, tenant_id, F_SEBI_ADVISORY) and len(body) > 15 and any(x in body.lower() for x in ["guarantee", "sure", "100%", "fixed return"]):
+        if flags.get(F_SEBI_ADVISORY, False) and len(body) > 15 and _RISKY_WORDING.search(low):
             safe = "✅ SEBI-safe version:\n“This is market-linked and subject to risk. Please consider your risk profile before investing.”\n\n(Connect your exact templates next)"
-            send_text(wa_from, safe)
-            return {"ok": True}
+            await send_text(wa_from, safe)
+            return
 
-        send_text(wa_from, "Reply 'Menu' to see options.")
-        return {"ok": True}
+        await send_text(wa_from, "Reply 'Menu' to see options.")
+        return
 
     except Exception as e:
-        return {"ok": False, "error": str(e)[:200]}
+        print("[ERR] process_inbound error:", str(e)[:200])
 
 
 # --------------------------
@@ -620,6 +847,7 @@ def admin_create_tenant(
     for k, v in DEFAULT_FLAGS_ON.items():
         set_flag(db, t.id, k, bool(v))
     enforce_plan(db, t.id)
+    _TENANT_CACHE.pop(t.id, None)
     return RedirectResponse(url=f"/dashboard?token={ADMIN_TOKEN}", status_code=303)
 
 
@@ -632,6 +860,7 @@ def admin_set_plan(request: Request, tenant_id: int, plan: str = Form(...), db:
     t.plan = plan
     db.commit()
     enforce_plan(db, tenant_id)
+    _TENANT_CACHE.pop(tenant_id, None)
     return RedirectResponse(url=f"/dashboard?token={ADMIN_TOKEN}&tenant_id={tenant_id}", status_code=303)
 
 
@@ -641,6 +870,7 @@ def admin_set_flag(request: Request, tenant_id: int, flag_key: str, enabled: str
     val = enabled.lower() in {"1", "true", "yes", "on"}
     set_flag(db, tenant_id, flag_key, val)
     enforce_plan(db, tenant_id)
+    _TENANT_CACHE.pop(tenant_id, None)
     return RedirectResponse(url=f"/dashboard?token={ADMIN_TOKEN}&tenant_id={tenant_id}", status_code=303)
 
 
@@ -653,22 +883,149 @@ def admin_list_flags(request: Request, tenant_id: int, db: Session = Depends(get
 # --------------------------
 # Admin Dashboard (HTML)
 # --------------------------
+_DASH_TPL = Template("""<!doctype html>
+<html>
+<head>
+  <meta charset="utf-8"/>
+  <meta name="viewport" content="width=device-width, initial-scale=1"/>
+  <title>NxMx StockExec AI — Dashboard</title>
+  <style>
+    body { background:#0b1220; color:#e5e7eb; font-family: Inter, Arial, sans-serif; margin:0; }
+    .wrap { max-width:1100px; margin:0 auto; padding:24px; }
+    .card { background:#111a2e; border:1px solid #243152; border-radius:16px; padding:18px; box-shadow:0 10px 24px rgba(0,0,0,.25);}
+    .grid { display:grid; grid-template-columns:1fr 1fr; gap:16px; }
+    h1 { margin:0 0 10px; font-size:26px; }
+    h2 { margin:0 0 10px; font-size:18px; color:#c7d2fe; }
+    .muted { color:#9ca3af; }
+    .row { display:flex; gap:12px; align-items:center; flex-wrap:wrap; }
+    select, input, button { border-radius:12px; border:1px solid #2b3a63; padding:10px 12px; background:#0b1220; color:#e5e7eb; }
+    .btn { cursor:pointer; font-weight:800; }
+    .btn-on { background:#0a7a54; border-color:#0a7a54; }
+    .btn-off { background:#8a2b2b; border-color:#8a2b2b; }
+    table { width:100%; border-collapse:collapse; }
+    .pill { display:inline-block; padding:6px 10px; border-radius:999px; background:#0b1220; border:1px solid #243152; }
+    a { color:#93c5fd; text-decoration:none; }
+  </style>
+</head>
+<body>
+  <div class="wrap">
+    <div class="row" style="justify-content:space-between;">
+      <div>
+        <div style="font-size:22px;font-weight:900;">NxMx StockExec AI — Admin Dashboard</div>
+        <div class="muted" style="font-size:13px;">Single-file • Plan enforcement • Feature flags</div>
+      </div>
+      <div class="row">
+        <span class="pill">Tenant #{{ selected.id }}: <b>{{ selected.name }}</b></span>
+        <span class="pill">Plan: <b>{{ selected.plan }}</b></span>
+        <span class="pill">Messages: <b>{{ msg_count }}</b></span>
+        <span class="pill">Last Msg: <b>{{ last_msg_str }}</b></span>
+      </div>
+    </div>
+
+    <div style="height:16px"></div>
+
+    <div class="grid">
+      <div class="card">
+        <h2>Select Tenant</h2>
+        <form method="get" action="/dashboard">
+          <input type="hidden" name="token" value="{{ admin_token }}"/>
+          <div class="row">
+            <select name="tenant_id" onchange="this.form.submit()">{{ tenant_options }}</select>
+            <noscript><button class="btn" type="submit">Open</button></noscript>
+          </div>
+        </form>
+
+        <div style="height:14px"></div>
+
+        <h2>Change Plan (auto-disables disallowed features)</h2>
+        <form method="post" action="/admin/tenants/{{ selected.id }}/plan?token={{ admin_token }}">
+          <div class="row">
+            <select name="plan">
+              <option value="starter" {% if selected.plan == "starter" %}selected{% endif %}>starter</option>
+              <option value="pro" {% if selected.plan == "pro" %}selected{% endif %}>pro</option>
+              <option value="elite" {% if selected.plan == "elite" %}selected{% endif %}>elite</option>
+              <option value="enterprise" {% if selected.plan == "enterprise" %}selected{% endif %}>enterprise</option>
+            </select>
+            <button class="btn" type="submit">Update Plan</button>
+          </div>
+        </form>
+
+        <div style="height:14px"></div>
+
+        <h2>Create New Tenant</h2>
+        <form method="post" action="/admin/tenants?token={{ admin_token }}">
+          <div class="row">
+            <input name="name" placeholder="Tenant name" required />
+            <input name="whatsapp_number" placeholder="WhatsApp number (optional)" />
+            <select name="plan">
+              <option value="starter">starter</option>
+              <option value="pro">pro</option>
+              <option value="elite">elite</option>
+              <option value="enterprise">enterprise</option>
+            </select>
+            <button class="btn" type="submit">Create</button>
+          </div>
+        </form>
+
+        <div style="height:14px"></div>
+        <div class="muted" style="font-size:13px;">
+          Webhook: <code>/webhook/whatsapp</code><br/>
+          Tip: Use <code>?token=YOUR_ADMIN_TOKEN</code> to open dashboard.
+        </div>
+      </div>
+
+      <div class="card">
+        <h2>Feature Flags (effective after enforcement)</h2>
+        <div class="muted" style="font-size:13px;">If plan doesn't allow a feature, it will turn OFF automatically.</div>
+        <div style="height:10px"></div>
+        <table>
+          <thead>
+            <tr>
+              <th style="text-align:left;padding:8px;border-bottom:1px solid #2b3a63;">Feature</th>
+              <th style="text-align:center;padding:8px;border-bottom:1px solid #2b3a63;">Toggle</th>
+            </tr>
+          </thead>
+          <tbody>{{ feature_rows }}</tbody>
+        </table>
+
+        <div style="height:12px"></div>
+        <div class="row">
+          <a href="/admin/tenants/{{ selected.id }}/flags?token={{ admin_token }}" target="_blank">View Flags JSON</a>
+          <span class="muted">|</span>
+          <a href="/" target="_blank">Health</a>
+          <span class="muted">|</span>
+          <a href="/debug/menu" target="_blank">Menu JSON</a>
+        </div>
+      </div>
+    </div>
+
+  </div>
+</body>
+</html>
+""")
+
+
 @app.get("/dashboard", response_class=HTMLResponse)
 def dashboard(request: Request, tenant_id: int = 0, db: Session = Depends(get_db)):
     require_admin(request)
 
-    tenants = db.scalars(select(Tenant).order_by(Tenant.id.asc())).all()
+    tenants = db.scalars(_TENANTS_ORDERED).all()
     if not tenants:
         ensure_default_tenant(db, DEFAULT_TENANT_ID)
-        tenants = db.scalars(select(Tenant).order_by(Tenant.id.asc())).all()
-
-    selected = db.get(Tenant, tenant_id) if tenant_id else tenants[0]
-    ensure_default_tenant(db, selected.id)
-    enforce_plan(db, selected.id)
+        tenants = db.scalars(_TENANTS_ORDERED).all()
+
+    selected = next((t for t in tenants if t.id == tenant_id), tenants[0])
+    if selected.id not in _SEEDED:
+        ensure_default_tenant(db, selected.id)
+    if _ENFORCED_PLAN.get(selected.id) != selected.plan:
+        enforce_plan(db, selected.id)
+        _TENANT_CACHE.pop(selected.id, None)  # enforcement may have switched flags off
     flags = get_flags(db, selected.id)
 
-    msg_count = db.scalar(select(func.count(MessageLog.id)).where(MessageLog.tenant_id == selected.id)) or 0
-    last_msg = db.scalar(select(func.max(MessageLog.created_at)).where(MessageLog.tenant_id == selected.id))
+    msg_count, last_msg = db.execute(
+        select(func.count(), func.max(MessageLog.created_at)).where(MessageLog.tenant_id == selected.id)
+    ).one()
+    msg_count = msg_count or 0
     last_msg_str = last_msg.isoformat() if last_msg else "—"
 
     tenant_options = "".join(
@@ -676,142 +1033,29 @@ def dashboard(request: Request, tenant_id: int = 0, db: Session = Depends(get_db
         for t in tenants
     )
 
-    feature_rows = ""
-    for k in sorted(flags.keys()):
-        next_val = "false" if flags[k] else "true"
-        feature_rows += f"""
+    feature_rows = "".join(
+        f"""
         <tr>
           <td style="padding:8px;border-bottom:1px solid #2b3a63;">{k}</td>
           <td style="padding:8px;border-bottom:1px solid #2b3a63;text-align:center;">
             <form method="post" action="/admin/tenants/{selected.id}/flags/{k}?token={ADMIN_TOKEN}">
-              <input type="hidden" name="enabled" value="{next_val}" />
+              <input type="hidden" name="enabled" value="{'false' if flags[k] else 'true'}" />
               <button class="btn {'btn-on' if flags[k] else 'btn-off'}" type="submit">{'ON' if flags[k] else 'OFF'}</button>
             </form>
           </td>
         </tr>
         """
+        for k in sorted(flags.keys())
+    )
 
-    html = f"""
-    <!doctype html>
-    <html>
-    <head>
-      <meta charset="utf-8"/>
-      <meta name="viewport" content="width=device-width, initial-scale=1"/>
-      <title>NxMx StockExec AI — Dashboard</title>
-      <style>
-        body {{ background:#0b1220; color:#e5e7eb; font-family: Inter, Arial, sans-serif; margin:0; }}
-        .wrap {{ max-width:1100px; margin:0 auto; padding:24px; }}
-        .card {{ background:#111a2e; border:1px solid #243152; border-radius:16px; padding:18px; box-shadow:0 10px 24px rgba(0,0,0,.25);}}
-        .grid {{ display:grid; grid-template-columns:1fr 1fr; gap:16px; }}
-        h1 {{ margin:0 0 10px; font-size:26px; }}
-        h2 {{ margin:0 0 10px; font-size:18px; color:#c7d2fe; }}
-        .muted {{ color:#9ca3af; }}
-        .row {{ display:flex; gap:12px; align-items:center; flex-wrap:wrap; }}
-        select, input, button {{ border-radius:12px; border:1px solid #2b3a63; padding:10px 12px; background:#0b1220; color:#e5e7eb; }}
-        .btn {{ cursor:pointer; font-weight:800; }}
-        .btn-on {{ background:#0a7a54; border-color:#0a7a54; }}
-        .btn-off {{ background:#8a2b2b; border-color:#8a2b2b; }}
-        table {{ width:100%; border-collapse:collapse; }}
-        .pill {{ display:inline-block; padding:6px 10px; border-radius:999px; background:#0b1220; border:1px solid #243152; }}
-        a {{ color:#93c5fd; text-decoration:none; }}
-      </style>
-    </head>
-    <body>
-      <div class="wrap">
-        <div class="row" style="justify-content:space-between;">
-          <div>
-            <div style="font-size:22px;font-weight:900;">NxMx StockExec AI — Admin Dashboard</div>
-            <div class="muted" style="font-size:13px;">Single-file • Plan enforcement • Feature flags</div>
-          </div>
-          <div class="row">
-            <span class="pill">Tenant #{selected.id}: <b>{selected.name}</b></span>
-            <span class="pill">Plan: <b>{selected.plan}</b></span>
-            <span class="pill">Messages: <b>{msg_count}</b></span>
-            <span class="pill">Last Msg: <b>{last_msg_str}</b></span>
-          </div>
-        </div>
-
-        <div style="height:16px"></div>
-
-        <div class="grid">
-          <div class="card">
-            <h2>Select Tenant</h2>
-            <form method="get" action="/dashboard">
-              <input type="hidden" name="token" value="{ADMIN_TOKEN}"/>
-              <div class="row">
-                <select name="tenant_id" onchange="this.form.submit()">{tenant_options}</select>
-                <noscript><button class="btn" type="submit">Open</button></noscript>
-              </div>
-            </form>
-
-            <div style="height:14px"></div>
-
-            <h2>Change Plan (auto-disables disallowed features)</h2>
-            <form method="post" action="/admin/tenants/{selected.id}/plan?token={ADMIN_TOKEN}">
-              <div class="row">
-                <select name="plan">
-                  <option value="starter" {"selected" if selected.plan=="starter" else ""}>starter</option>
-                  <option value="pro" {"selected" if selected.plan=="pro" else ""}>pro</option>
-                  <option value="elite" {"selected" if selected.plan=="elite" else ""}>elite</option>
-                  <option value="enterprise" {"selected" if selected.plan=="enterprise" else ""}>enterprise</option>
-                </select>
-                <button class="btn" type="submit">Update Plan</button>
-              </div>
-            </form>
-
-            <div style="height:14px"></div>
-
-            <h2>Create New Tenant</h2>
-            <form method="post" action="/admin/tenants?token={ADMIN_TOKEN}">
-              <div class="row">
-                <input name="name" placeholder="Tenant name" required />
-                <input name="whatsapp_number" placeholder="WhatsApp number (optional)" />
-                <select name="plan">
-                  <option value="starter">starter</option>
-                  <option value="pro">pro</option>
-                  <option value="elite">elite</option>
-                  <option value="enterprise">enterprise</option>
-                </select>
-                <button class="btn" type="submit">Create</button>
-              </div>
-            </form>
-
-            <div style="height:14px"></div>
-            <div class="muted" style="font-size:13px;">
-              Webhook: <code>/webhook/whatsapp</code><br/>
-              Tip: Use <code>?token=YOUR_ADMIN_TOKEN</code> to open dashboard.
-            </div>
-          </div>
-
-          <div class="card">
-            <h2>Feature Flags (effective after enforcement)</h2>
-            <div class="muted" style="font-size:13px;">If plan doesn't allow a feature, it will turn OFF automatically.</div>
-            <div style="height:10px"></div>
-            <table>
-              <thead>
-                <tr>
-                  <th style="text-align:left;padding:8px;border-bottom:1px solid #2b3a63;">Feature</th>
-                  <th style="text-align:center;padding:8px;border-bottom:1px solid #2b3a63;">Toggle</th>
-                </tr>
-              </thead>
-              <tbody>{feature_rows}</tbody>
-            </table>
-
-            <div style="height:12px"></div>
-            <div class="row">
-              <a href="/admin/tenants/{selected.id}/flags?token={ADMIN_TOKEN}" target="_blank">View Flags JSON</a>
-              <span class="muted">|</span>
-              <a href="/" target="_blank">Health</a>
-              <span class="muted">|</span>
-              <a href="/debug/menu" target="_blank">Menu JSON</a>
-            </div>
-          </div>
-        </div>
-
-      </div>
-    </body>
-    </html>
-    """
+    html = _DASH_TPL.render(
+        selected=selected,
+        msg_count=msg_count,
+        last_msg_str=last_msg_str,
+        tenant_options=tenant_options,
+        feature_rows=feature_rows,
+        admin_token=ADMIN_TOKEN,
+    )
     return HTMLResponse(content=html)
 
 
@@ -1,15 +1,26 @@
+import logging
+import logging.handlers
 import os
+import queue
 import time
+from collections import OrderedDict, deque
 from datetime import datetime, timezone, timedelta
-from typing import Optional
-
-import requests
-from fastapi import FastAPI, Request, Form
-from fastapi.responses import PlainTextResponse, JSONResponse, HTMLResponse, RedirectResponse
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, ForeignKey, func, or_
-from sqlalchemy.orm import declarative_base, sessionmaker, relationship
+from typing import Deque, Dict, NamedTuple, Optional, Tuple
+
+import httpx
+import orjson
+from fastapi import BackgroundTasks, Depends, FastAPI, HTTPException, Request, Form
+from fastapi.concurrency import run_in_threadpool
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import PlainTextResponse, ORJSONResponse, HTMLResponse, RedirectResponse
+from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, Index, event, func, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.orm import declarative_base, relationship
 from passlib.hash import pbkdf2_sha256
 from itsdangerous import URLSafeSerializer, BadSignature
+from jinja2 import Environment
+from openai import AsyncOpenAI
 from sqlalchemy.orm import joinedload
 
 IST_OFFSET = timedelta(hours=5, minutes=30)
@@ -39,12 +50,63 @@ AGENT2_EMAIL = os.getenv("AGENT2_EMAIL", "agent2@beyond.com")
 AGENT2_PASSWORD = os.getenv("AGENT2_PASSWORD", "agent123")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "").strip()
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
-
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+# ========== LOGGING ==========
+# Handlers only enqueue; a listener thread does the stdout writes so request paths never block on the pipe
+logger = logging.getLogger(__name__)
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+_log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+log_listener = logging.handlers.QueueListener(_log_queue, _log_stream)
 
 # ========== DB ==========
-connect_args = {"check_same_thread": False} if DB_URL.startswith("sqlite") else {}
-engine = create_engine(DB_URL, connect_args=connect_args, pool_pre_ping=True)
-SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+def async_db_url(url: str) -> str:
+    # Accept the usual sync URLs from env and switch them to an async driver
+    if url.startswith("sqlite:///"):
+        return "sqlite+aiosqlite:///" + url[len("sqlite:///"):]
+    if url.startswith("postgres://"):
+        return "postgresql+asyncpg://" + url[len("postgres://"):]
+    if url.startswith("postgresql://"):
+        return "postgresql+asyncpg://" + url[len("postgresql://"):]
+    if url.startswith("postgresql+psycopg2://"):
+        # psycopg2 has no asyncio support; asyncpg (see requirements.txt) takes its place
+        return "postgresql+asyncpg://" + url[len("postgresql+psycopg2://"):]
+    return url
+
+ASYNC_DB_URL = async_db_url(DB_URL)
+IS_SQLITE = ASYNC_DB_URL.startswith("sqlite")
+# aiosqlite defaults to NullPool (a new connection per session), which would drop the per-connection
+# pragmas and page cache below on every request; keep a few SQLite connections alive instead
+pool_args = (
+    {"poolclass": AsyncAdaptedQueuePool, "pool_size": 5, "max_overflow": 5}
+    if IS_SQLITE else {"pool_size": 15, "max_overflow": 15}
+)
+engine = create_async_engine(ASYNC_DB_URL, pool_pre_ping=True, **pool_args)
+
+if IS_SQLITE:
+    @event.listens_for(engine.sync_engine, "connect")
+    def _sqlite_pragmas(dbapi_conn, _conn_record):
+        # WAL lets inbox reads run alongside webhook writes; NORMAL sync avoids an fsync per commit
+        cur = dbapi_conn.cursor()
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        cur.execute("PRAGMA temp_store=MEMORY")
+        cur.execute("PRAGMA mmap_size=268435456")
+        cur.execute("PRAGMA cache_size=-65536")
+        cur.close()
+
+if engine.dialect.name == "sqlite":
+    from sqlalchemy.dialects.sqlite import insert as upsert_insert
+elif engine.dialect.name == "postgresql":
+    from sqlalchemy.dialects.postgresql import insert as upsert_insert
+else:
+    upsert_insert = None
+
+AsyncSessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
 class Agent(Base):
@@ -54,7 +116,7 @@ class Agent(Base):
     name = Column(String(255), nullable=False)
     role = Column(String(20), nullable=False)  # admin/agent
     password_hash = Column(String(255), nullable=False)
-    created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
 
 class Conversation(Base):
     __tablename__ = "conversations"
@@ -65,7 +127,7 @@ class Conversation(Base):
     mode = Column(String(10), default="ai")      # ai/human  <-- handoff switch
     assigned_agent_id = Column(Integer, ForeignKey("agents.id"), nullable=True)
     last_message_at = Column(DateTime(timezone=True), nullable=True)
-    created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
 
     assigned_agent = relationship("Agent")
     messages = relationship("Message", back_populates="conversation", cascade="all, delete-orphan")
@@ -77,14 +139,32 @@ class Message(Base):
     direction = Column(String(10), nullable=False)  # inbound/outbound
     message_id = Column(String(128), unique=True, index=True, nullable=True)
     text = Column(Text, nullable=True)
-    ts_utc = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    ts_utc = Column(DateTime(timezone=True), server_default=func.now())
     sent_by_agent_id = Column(Integer, ForeignKey("agents.id"), nullable=True)
     sent_by_ai = Column(Integer, default=0)  # 1/0
 
     conversation = relationship("Conversation", back_populates="messages")
     sent_by_agent = relationship("Agent")
 
-Base.metadata.create_all(bind=engine)
+# Matches the inbox ORDER BY so the 50-row listing is an index range scan.
+# SQLite can't index NULLS LAST, but its DESC order already puts NULLs last.
+_last_msg_desc = Conversation.last_message_at.desc()
+ix_conv_last_msg_desc = Index(
+    "ix_conv_last_msg_desc",
+    _last_msg_desc if IS_SQLITE else _last_msg_desc.nullslast(),
+    Conversation.id.desc(),
+)
+
+# Chat timeline (chat_view): filter by conversation, walk by timestamp.
+# load_history orders by id instead, which ix_messages_conversation_id already covers.
+ix_msg_conv_ts = Index("ix_msg_conv_ts", Message.conversation_id, Message.ts_utc)
+
+async def init_db():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        # create_all skips tables that already exist, so add the indexes on older databases too
+        await conn.run_sync(lambda sync_conn: ix_conv_last_msg_desc.create(sync_conn, checkfirst=True))
+        await conn.run_sync(lambda sync_conn: ix_msg_conv_ts.create(sync_conn, checkfirst=True))
 
 # ========== AUTH ==========
 serializer = URLSafeSerializer(SESSION_SECRET, salt="team-inbox")
@@ -96,7 +176,30 @@ def set_session(resp: HTMLResponse, agent_id: int):
 def clear_session(resp: HTMLResponse):
     resp.delete_cookie("session")
 
-def get_current_agent(request: Request) -> Optional[Agent]:
+async def get_db():
+    # One session per request; commits whatever the handler left pending, rolls back on error
+    async with AsyncSessionLocal() as db:
+        try:
+            yield db
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+
+# Agent rows almost never change; keep them for a minute so page views skip the lookup
+AGENT_CACHE_TTL = 60
+AGENT_CACHE_MAX = 256
+
+class CurrentAgent(NamedTuple):
+    # Immutable snapshot: safe to share across requests, unlike an ORM row bound to one session
+    id: int
+    email: str
+    name: str
+    role: str
+
+AGENT_CACHE: Dict[int, Tuple[float, CurrentAgent]] = {}
+
+async def get_current_agent(request: Request, db: AsyncSession = Depends(get_db)) -> Optional[CurrentAgent]:
     token = request.cookies.get("session")
     if not token:
         return None
@@ -105,73 +208,130 @@ def get_current_agent(request: Request) -> Optional[Agent]:
         agent_id = data.get("agent_id")
         if not agent_id:
             return None
-        db = SessionLocal()
-        agent = db.query(Agent).filter(Agent.id == agent_id).first()
-        db.close()
+
+        now = time.monotonic()
+        hit = AGENT_CACHE.get(agent_id)
+        if hit and hit[0] > now:
+            return hit[1]
+
+        row = (await db.execute(
+            select(Agent.id, Agent.email, Agent.name, Agent.role).where(Agent.id == agent_id)
+        )).one_or_none()
+        if not row:
+            return None
+        agent = CurrentAgent(*row)
+        if len(AGENT_CACHE) >= AGENT_CACHE_MAX:
+            AGENT_CACHE.clear()
+        AGENT_CACHE[agent_id] = (now + AGENT_CACHE_TTL, agent)
         return agent
     except BadSignature:
         return None
 
-def require_login(request: Request) -> Optional[Agent]:
-    agent = get_current_agent(request)
+async def require_login(agent: Optional[CurrentAgent] = Depends(get_current_agent)) -> Optional[CurrentAgent]:
     return agent
 
-def seed_agents():
-    db = SessionLocal()
-
-    def upsert(email, name, role, password):
-        # If already exists, don't insert again
-        existing = db.query(Agent).filter(Agent.email == email).first()
-        if existing:
+async def seed_agents():
+    seeds = [
+        (ADMIN_EMAIL, "Admin", "admin", ADMIN_PASSWORD),
+        (AGENT1_EMAIL, "Agent 1", "agent", AGENT1_PASSWORD),
+        (AGENT2_EMAIL, "Agent 2", "agent", AGENT2_PASSWORD),
+    ]
+    async with AsyncSessionLocal() as db:
+        # After first boot every seed exists: one SELECT and no PBKDF2 work at all
+        existing = set((await db.execute(
+            select(Agent.email).where(Agent.email.in_([email for email, *_ in seeds]))
+        )).scalars())
+        missing = [seed for seed in seeds if seed[0] not in existing]
+        if not missing:
             return
 
-        db.add(Agent(
-            email=email,
-            name=name,
-            role=role,
-            password_hash=pbkdf2_sha256.hash(password),
-        ))
-
-    upsert(ADMIN_EMAIL, "Admin", "admin", ADMIN_PASSWORD)
-    upsert(AGENT1_EMAIL, "Agent 1", "agent", AGENT1_PASSWORD)
-    upsert(AGENT2_EMAIL, "Agent 2", "agent", AGENT2_PASSWORD)
-
-    try:
-        db.commit()
-    except Exception:
-        # In case of a rare race condition on deploy/restart
-        db.rollback()
-    finally:
-        db.close()
-
-
-seed_agents()
+        rows = [
+            {
+                "email": email,
+                "name": name,
+                "role": role,
+                # PBKDF2 is pure CPU; keep it off the event loop
+                "password_hash": await run_in_threadpool(pbkdf2_sha256.hash, password),
+            }
+            for email, name, role, password in missing
+        ]
+
+        try:
+            if upsert_insert is not None:
+                # Parallel workers booting together may race; losers simply skip the row
+                await db.execute(upsert_insert(Agent).on_conflict_do_nothing(index_elements=[Agent.email]), rows)
+            else:
+                db.add_all(Agent(**row) for row in rows)
+            await db.commit()
+        except Exception:
+            # In case of a rare race condition on deploy/restart
+            await db.rollback()
+
+
+# ========== HTTP ==========
+# Invariant per process: built once instead of on every send
+WA_URL = f"https://graph.facebook.com/{GRAPH_VERSION}/{PHONE_NUMBER_ID}/messages"
+WA_HEADERS = {"Authorization": f"Bearer {WHATSAPP_TOKEN}", "Content-Type": "application/json"}
+
+# Shared outbound client so Graph API sends reuse TCP/TLS connections
+_client: Optional[httpx.AsyncClient] = None
+
+def http_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=30,
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+        )
+    return _client
 
 # ========== APP ==========
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
+# Inbox/chat pages grow with escaped message text; tiny JSON acks stay uncompressed
+app.add_middleware(GZipMiddleware, minimum_size=500)
+
+@app.on_event("startup")
+async def _startup():
+    log_listener.start()
+    await init_db()
+    await seed_agents()
+    if not WHATSAPP_TOKEN or not PHONE_NUMBER_ID:
+        logger.warning("WHATSAPP_TOKEN / PHONE_NUMBER_ID not set; outbound WhatsApp sends will fail")
+    http_client()
+
+@app.on_event("shutdown")
+async def _shutdown():
+    global _client, _openai
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+    if _openai is not None:
+        await _openai.close()
+        _openai = None
+    await engine.dispose()
+    log_listener.stop()
 
 @app.get("/dashboard/daily", response_class=HTMLResponse)
-def dashboard_daily(request: Request):
-    agent = require_login(request)
+async def dashboard_daily(agent: Optional[CurrentAgent] = Depends(require_login), db: AsyncSession = Depends(get_db)):
     if not agent:
         return RedirectResponse("/login", status_code=302)
 
-    db = SessionLocal()
     # last 1 day
     since = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
 
-    rows = db.query(
-        Conversation.wa_id,
-        Conversation.customer_name,
-        func.count(Message.id).label("msg_count"),
-        func.max(Message.ts_utc).label("last_ts"),
-    ).join(Message, Message.conversation_id == Conversation.id)\
-     .filter(Message.direction == "inbound")\
-     .filter(Message.ts_utc >= since)\
-     .group_by(Conversation.wa_id, Conversation.customer_name)\
-     .order_by(func.count(Message.id).desc())\
-     .all()
-    db.close()
+    rows = (await db.execute(
+        select(
+            Conversation.wa_id,
+            Conversation.customer_name,
+            func.count(Message.id).label("msg_count"),
+            func.max(Message.ts_utc).label("last_ts"),
+        ).join(Message, Message.conversation_id == Conversation.id)
+         .where(Message.direction == "inbound")
+         .where(Message.ts_utc >= since)
+         .group_by(Conversation.wa_id, Conversation.customer_name)
+         .order_by(func.count(Message.id).desc())
+    )).all()
 
     tr = ""
     for wa_id, name, msg_count, last_ts in rows:
@@ -209,64 +369,111 @@ async def verify_webhook(request: Request):
 
     return PlainTextResponse("Verification failed", status_code=403)
 
-def wa_send_text(to: str, text: str):
-    url = f"https://graph.facebook.com/{GRAPH_VERSION}/{PHONE_NUMBER_ID}/messages"
-    headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}", "Content-Type": "application/json"}
+async def wa_send_text(to: str, text: str):
     payload = {"messaging_product": "whatsapp", "to": to, "type": "text", "text": {"body": text[:4096]}}
-    r = requests.post(url, headers=headers, json=payload, timeout=30)
+    r = await http_client().post(WA_URL, headers=WA_HEADERS, content=orjson.dumps(payload))
+    if r.status_code >= 400:
+        logger.warning("wa_send to=%s status=%s body=%.200s", to, r.status_code, r.text)
+    else:
+        logger.debug("wa_send to=%s status=%s", to, r.status_code)
     return r.status_code, r.text
 
+# Prompt context comes from the messages table, so it is bounded, survives restarts and is shared by workers
+HISTORY_TURNS = 12
+HISTORY_BUDGET_CHARS = 6000  # cheap stand-in for a token budget
+
+async def load_history(db: AsyncSession, conversation_id: int) -> Deque[dict]:
+    rows = (await db.execute(
+        select(Message.direction, Message.text)
+        .where(Message.conversation_id == conversation_id)
+        # id is arrival order; ts_utc mixes Meta's send time (inbound) with our clock (outbound)
+        .order_by(Message.id.desc())
+        .limit(HISTORY_TURNS)
+    )).all()
+
+    # Rows come newest first; appendleft yields chronological order with no reverse/slice copies.
+    # SYSTEM_MSG is never part of this window, so it can't be trimmed away.
+    history: Deque[dict] = deque(maxlen=HISTORY_TURNS)
+    used = 0
+    for direction, text in rows:  # stop once the budget is spent
+        text = text or ""
+        if history and used + len(text) > HISTORY_BUDGET_CHARS:
+            break
+        used += len(text)
+        history.appendleft({"role": "user" if direction == "inbound" else "assistant", "content": text})
+    return history
+
 # --- Plug your AI here (keep your existing OpenAI function if you already have it) ---
-def get_ai_reply(conversation_id: int, user_text: str) -> str:
+SYSTEM_MSG = {"role": "system", "content": "You are a helpful WhatsApp assistant. Keep replies short and clear."}
+
+_openai: Optional[AsyncOpenAI] = None
+
+def openai_client() -> AsyncOpenAI:
+    global _openai
+    if _openai is None:
+        _openai = AsyncOpenAI(api_key=OPENAI_API_KEY, timeout=30)
+    return _openai
+
+async def get_ai_reply(conversation_id: int, user_text: str, history: Optional[Deque[dict]] = None) -> str:
     # If key missing, don't break webhook; return fallback
     if not OPENAI_API_KEY:
         return "AI is not configured yet. A human will get back to you shortly."
 
     try:
-        url = "https://api.openai.com/v1/chat/completions"
-        headers = {
-            "Authorization": f"Bearer {OPENAI_API_KEY}",
-            "Content-Type": "application/json",
-        }
-        payload = {
-            "model": OPENAI_MODEL,
-            "messages": [
-                {"role": "system", "content": "You are a helpful WhatsApp assistant. Keep replies short and clear."},
-                {"role": "user", "content": user_text},
-            ],
-            "temperature": 0.3,
-        }
-
-        r = requests.post(url, headers=headers, json=payload, timeout=30)
-        r.raise_for_status()
-        data = r.json()
-        return (data["choices"][0]["message"]["content"] or "").strip() or "Okay."
+        # Streamed so the event loop keeps serving other conversations while tokens arrive
+        # The message being answered must be the last turn, even if another reply landed after it
+        turn = {"role": "user", "content": user_text}
+        messages = [SYSTEM_MSG, *(history or ())]
+        if messages[-1] != turn:
+            messages.append(turn)
+        stream = await openai_client().chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=messages,
+            temperature=0.3,
+            stream=True,
+        )
+        chunks = []
+        async for part in stream:
+            if part.choices:
+                chunks.append(part.choices[0].delta.content or "")
+        return "".join(chunks).strip() or "Okay."
     except Exception as e:
-        print("OpenAI error:", repr(e))
+        logger.warning("OpenAI error: %r", e)
         return "I’m having trouble replying right now. A human will get back to you shortly."
 
-def upsert_conversation(db, wa_id: str, customer_name: Optional[str]) -> Conversation:
-    conv = db.query(Conversation).filter(Conversation.wa_id == wa_id).first()
-    now = datetime.now(timezone.utc)
+async def upsert_conversation(db: AsyncSession, wa_id: str, customer_name: Optional[str], now: Optional[datetime] = None) -> Tuple[int, str]:
+    """Create or touch the customer's conversation; returns (id, mode) so callers never re-read it."""
+    if now is None:
+        now = datetime.now(timezone.utc)
+    if upsert_insert is not None:
+        # One statement: insert or bump last_message_at, and hand back the current mode
+        stmt = upsert_insert(Conversation).values(wa_id=wa_id, customer_name=customer_name, last_message_at=now)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Conversation.wa_id],
+            set_={
+                "last_message_at": stmt.excluded.last_message_at,
+                "customer_name": func.coalesce(func.nullif(Conversation.customer_name, ""), stmt.excluded.customer_name),
+            },
+        ).returning(Conversation.id, Conversation.mode)
+        row = (await db.execute(stmt)).one()
+        return row.id, row.mode
+
+    conv = (await db.execute(select(Conversation).where(Conversation.wa_id == wa_id))).scalar_one_or_none()
     if not conv:
         conv = Conversation(wa_id=wa_id, customer_name=customer_name, last_message_at=now)
         db.add(conv)
-        db.flush()
+        await db.flush()
     else:
         if customer_name and not conv.customer_name:
             conv.customer_name = customer_name
         conv.last_message_at = now
-    return conv
+    return conv.id, conv.mode
 
-def save_message(db, conv_id: int, direction: str, text: str, message_id: Optional[str], sent_by_agent_id=None, sent_by_ai=0, ts=None):
+async def save_message(db: AsyncSession, conv_id: int, direction: str, text: str, message_id: Optional[str], sent_by_agent_id=None, sent_by_ai=0, ts=None) -> bool:
+    """Store a message; returns False when message_id was already stored (a webhook retry)."""
     if ts is None:
         ts = datetime.now(timezone.utc)
-    # avoid duplicates for inbound message_id
-    if message_id:
-        exists = db.query(Message).filter(Message.message_id == message_id).first()
-        if exists:
-            return exists
-    m = Message(
+    values = dict(
         conversation_id=conv_id,
         direction=direction,
         text=text,
@@ -275,13 +482,65 @@ def save_message(db, conv_id: int, direction: str, text: str, message_id: Option
         sent_by_agent_id=sent_by_agent_id,
         sent_by_ai=sent_by_ai,
     )
-    db.add(m)
-    return m
+    if message_id:
+        # avoid duplicates for inbound message_id: the unique index decides, in the same round-trip as the insert
+        if upsert_insert is not None:
+            res = await db.execute(
+                upsert_insert(Message).values(**values).on_conflict_do_nothing(index_elements=[Message.message_id])
+            )
+            return res.rowcount > 0
+        exists = (await db.execute(select(Message.id).where(Message.message_id == message_id).limit(1))).scalar()
+        if exists:
+            return False
+    db.add(Message(**values))
+    return True
+
+async def process_and_reply(conv_id: int, to: str, user_text: str):
+    # Runs after the webhook has been ACKed. No transaction is held across the OpenAI
+    # and Graph API calls: a short read for context, then a short write for the reply.
+    try:
+        async with AsyncSessionLocal() as db:
+            history = await load_history(db, conv_id)
+
+        ai_text = await get_ai_reply(conv_id, user_text, history)
+        await wa_send_text(to, ai_text)
+
+        # store outbound
+        async with AsyncSessionLocal() as db:
+            await save_message(db, conv_id, "outbound", ai_text, None, sent_by_ai=1, ts=datetime.now(timezone.utc))
+            await db.commit()
+    except Exception:
+        logger.exception("AI reply failed for conversation %s", conv_id)
+
+# Recently stored inbound message ids: Meta retries are answered without touching the DB.
+# Insertion-ordered, so expired ids are always at the front.
+SEEN_MSG_TTL = 600
+SEEN_MSG_MAX = 50_000
+SEEN_MSG_IDS: "OrderedDict[str, float]" = OrderedDict()
+
+def seen_recently(msg_id: str) -> bool:
+    expires = SEEN_MSG_IDS.get(msg_id)
+    return expires is not None and expires > time.monotonic()
+
+def mark_seen(msg_id: str):
+    now = time.monotonic()
+    SEEN_MSG_IDS[msg_id] = now + SEEN_MSG_TTL
+    SEEN_MSG_IDS.move_to_end(msg_id)
+    while SEEN_MSG_IDS and (len(SEEN_MSG_IDS) > SEEN_MSG_MAX or next(iter(SEEN_MSG_IDS.values())) <= now):
+        SEEN_MSG_IDS.popitem(last=False)
+
+async def read_json(request: Request) -> dict:
+    # Starlette's request.json() goes through stdlib json; orjson parses the raw body faster
+    try:
+        return orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
 
 # --- Incoming WhatsApp events ---
 @app.post("/webhook/whatsapp")
-async def receive_webhook(request: Request):
-    payload = await request.json()
+async def receive_webhook(request: Request, background_tasks: BackgroundTasks, db: AsyncSession = Depends(get_db)):
+    payload = await read_json(request)
+    now = datetime.now(timezone.utc)
 
     try:
         changes = payload["entry"][0]["changes"][0]["value"]
@@ -289,7 +548,7 @@ async def receive_webhook(request: Request):
         contacts = changes.get("contacts", [])
 
         if not messages:
-            return JSONResponse({"status": "ok"})  # statuses etc.
+            return ORJSONResponse({"status": "ok"})  # statuses etc.
 
         msg = messages[0]
         from_number = msg.get("from")
@@ -302,31 +561,27 @@ async def receive_webhook(request: Request):
             customer_name = (contacts[0].get("profile", {}) or {}).get("name")
 
         if not from_number or not text_body:
-            return JSONResponse({"status": "ok"})
-
-        db = SessionLocal()
-        conv = upsert_conversation(db, from_number, customer_name)
-        save_message(db, conv.id, "inbound", text_body, msg_id, ts=ts)
-        db.commit()
+            return ORJSONResponse({"status": "ok"})
+        if msg_id and seen_recently(msg_id):
+            return ORJSONResponse({"status": "ok"})  # retry of a message this worker already stored
+
+        conv_id, mode = await upsert_conversation(db, from_number, customer_name, now)
+        is_new = await save_message(db, conv_id, "inbound", text_body, msg_id, ts=ts)
+        await db.commit()
+        if msg_id:
+            mark_seen(msg_id)  # only after commit, so a failed insert still gets processed on retry
+        if not is_new:
+            return ORJSONResponse({"status": "ok"})  # Meta retry of a message we already handled
 
         # HUMAN HANDOFF: if conversation in human mode, do NOT auto-reply
-        conv = db.query(Conversation).filter(Conversation.id == conv.id).first()
-        if conv.mode == "human":
-            db.close()
-            return JSONResponse({"status": "ok"})
-
-        # AI mode -> reply
-        ai_text = get_ai_reply(conv.id, text_body)
-        status_code, resp_text = wa_send_text(from_number, ai_text)
-
-        # store outbound
-        save_message(db, conv.id, "outbound", ai_text, None, sent_by_ai=1, ts=datetime.now(timezone.utc))
-        db.commit()
-        db.close()
+        if mode == "human":
+            return ORJSONResponse({"status": "ok"})
 
-        return JSONResponse({"status": "ok", "wa_send_status": status_code})
+        # ACK Meta right away; the AI round-trip and outbound send happen after the response
+        background_tasks.add_task(process_and_reply, conv_id, from_number, text_body)
+        return ORJSONResponse({"status": "ok"})
     except Exception as e:
-        return JSONResponse({"status": "error", "detail": str(e)})
+        return ORJSONResponse({"status": "error", "detail": str(e)})
 
 # ========== TEAM INBOX UI ==========
 LOGIN_HTML = """
@@ -342,16 +597,79 @@ LOGIN_HTML = """
 </body></html>
 """
 
+# Compiled once at import; autoescape keeps customer names and message text from injecting HTML
+templates = Environment(autoescape=True)
+templates.filters["ist"] = to_ist
+
+INBOX_TPL = templates.from_string("""
+    <html><body style="font-family:Arial;padding:16px">
+    <div style="display:flex;justify-content:space-between;align-items:center">
+      <h2>Team Inbox</h2>
+      <div>Logged in: <b>{{ agent.email }}</b> ({{ agent.role }}) | <a href="/logout">Logout</a></div>
+    </div>
+    <table border="1" cellpadding="8" cellspacing="0">
+      <tr><th>WA ID</th><th>Name</th><th>Status</th><th>Mode</th><th>Assigned</th><th>Last Msg</th></tr>
+      {% for c in convs %}
+        <tr>
+          <td><a href="/inbox/chat/{{ c.id }}">{{ c.wa_id }}</a></td>
+          <td>{{ c.customer_name or "" }}</td>
+          <td>{{ c.status }}</td>
+          <td>{{ c.mode }}</td>
+          <td>{{ c.assigned_agent.name if c.assigned_agent else "" }}</td>
+          <td>{{ c.last_message_at | ist }}</td>
+        </tr>
+      {% endfor %}
+    </table>
+    </body></html>
+""")
+
+CHAT_TPL = templates.from_string("""
+    <html><body style="font-family:Arial;padding:16px;max-width:900px">
+    <a href="/inbox">← Back</a>
+    <h2>Chat: {{ conv.wa_id }} {{ conv.customer_name or "" }}</h2>
+    <p>Status: <b>{{ conv.status }}</b> | Mode: <b>{{ conv.mode }}</b> | Assigned: <b>{{ conv.assigned_agent.name if conv.assigned_agent else "Unassigned" }}</b></p>
+
+    <form method="post" action="/api/conversations/{{ conv.id }}/assign">
+      <button>Assign to me</button>
+    </form>
+
+    <form method="post" action="/api/conversations/{{ conv.id }}/mode" style="margin-top:8px">
+      <input type="hidden" name="mode" value="human"/>
+      <button>Handoff to Human</button>
+    </form>
+
+    <form method="post" action="/api/conversations/{{ conv.id }}/mode" style="margin-top:8px">
+      <input type="hidden" name="mode" value="ai"/>
+      <button>Return to AI</button>
+    </form>
+
+    <hr/>
+    <div style="background:#f6f6f6;padding:12px;border-radius:8px">
+    {%- for m in msgs -%}
+      <div style='margin:6px 0'><span style='color:#666'>{{ m.ts_utc | ist }}</span> <b>{{ "Customer" if m.direction == "inbound" else ("AI" if m.sent_by_ai else "Agent") }}:</b> {{ m.text }}</div>
+    {%- endfor -%}
+    </div>
+
+    <hr/>
+    <h3>Reply (Agent)</h3>
+    <form method="post" action="/api/conversations/{{ conv.id }}/reply">
+      <textarea name="text" style="width:100%;height:90px;padding:8px"></textarea><br/>
+      <button style="margin-top:8px;padding:10px 14px">Send</button>
+    </form>
+
+    </body></html>
+""")
+
 @app.get("/login", response_class=HTMLResponse)
 def login_page():
     return HTMLResponse(LOGIN_HTML)
 
 @app.post("/login")
-def login(email: str = Form(...), password: str = Form(...)):
-    db = SessionLocal()
-    agent = db.query(Agent).filter(Agent.email == email).first()
-    db.close()
-    if not agent or not pbkdf2_sha256.verify(password, agent.password_hash):
+async def login(email: str = Form(...), password: str = Form(...), db: AsyncSession = Depends(get_db)):
+    agent = (await db.execute(select(Agent).where(Agent.email == email))).scalar_one_or_none()
+    # PBKDF2 verify takes tens of ms of CPU; run it in the threadpool so webhooks aren't stalled
+    ok = await run_in_threadpool(pbkdf2_sha256.verify, password, agent.password_hash) if agent else False
+    if not ok:
         return HTMLResponse("<h3>Invalid credentials</h3><a href='/login'>Try again</a>", status_code=401)
     resp = RedirectResponse("/inbox", status_code=302)
     set_session(resp, agent.id)
@@ -364,172 +682,93 @@ def logout():
     return resp
 
 @app.get("/inbox", response_class=HTMLResponse)
-def inbox(request: Request):
-    agent = require_login(request)
+async def inbox(agent: Optional[CurrentAgent] = Depends(require_login), db: AsyncSession = Depends(get_db)):
     if not agent:
         return RedirectResponse("/login", status_code=302)
 
-    db = SessionLocal()
-
     q = (
-        db.query(Conversation)
-        .options(joinedload(Conversation.assigned_agent))
+        select(Conversation)
+        .options(joinedload(Conversation.assigned_agent).load_only(Agent.name))
     )
 
     # Admin sees all; Agents see only unassigned + assigned-to-me
     if agent.role != "admin":
-        q = q.filter(or_(Conversation.assigned_agent_id == None, Conversation.assigned_agent_id == agent.id))
+        q = q.where(or_(Conversation.assigned_agent_id == None, Conversation.assigned_agent_id == agent.id))
 
-    convs = (
+    convs = (await db.execute(
         q.order_by(Conversation.last_message_at.desc().nullslast(), Conversation.id.desc())
          .limit(50)
-         .all()
-    )
-    db.close()
+    )).scalars().all()
 
 
-    rows = ""
-    for c in convs:
-        assignee = f"{c.assigned_agent.name}" if c.assigned_agent else ""
-        rows += f"""
-        <tr>
-          <td><a href="/inbox/chat/{c.id}">{c.wa_id}</a></td>
-          <td>{(c.customer_name or "")}</td>
-          <td>{c.status}</td>
-          <td>{c.mode}</td>
-          <td>{assignee}</td>
-          <td>{to_ist(c.last_message_at)}</td>
-        </tr>
-        """
-
-    return HTMLResponse(f"""
-    <html><body style="font-family:Arial;padding:16px">
-    <div style="display:flex;justify-content:space-between;align-items:center">
-      <h2>Team Inbox</h2>
-      <div>Logged in: <b>{agent.email}</b> ({agent.role}) | <a href="/logout">Logout</a></div>
-    </div>
-    <table border="1" cellpadding="8" cellspacing="0">
-      <tr><th>WA ID</th><th>Name</th><th>Status</th><th>Mode</th><th>Assigned</th><th>Last Msg</th></tr>
-      {rows}
-    </table>
-    </body></html>
-    """)
+    return HTMLResponse(INBOX_TPL.render(agent=agent, convs=convs))
 
 @app.get("/inbox/chat/{conv_id}", response_class=HTMLResponse)
-def chat_view(request: Request, conv_id: int):
-    agent = require_login(request)
+async def chat_view(conv_id: int, agent: Optional[CurrentAgent] = Depends(require_login), db: AsyncSession = Depends(get_db)):
     if not agent:
         return RedirectResponse("/login", status_code=302)
 
-    db = SessionLocal()
-    conv = (
-    	db.query(Conversation)
-    	.options(joinedload(Conversation.assigned_agent))
-    	.filter(Conversation.id == conv_id)
-    	.first()
-    )
+    conv = (await db.execute(
+        select(Conversation)
+        .options(joinedload(Conversation.assigned_agent).load_only(Agent.name))
+        .where(Conversation.id == conv_id)
+    )).scalar_one_or_none()
 
-    msgs = db.query(Message).filter(Message.conversation_id == conv_id).order_by(Message.ts_utc.asc()).all()
-    db.close()
+    msgs = (await db.execute(
+        select(Message).where(Message.conversation_id == conv_id).order_by(Message.ts_utc.asc())
+    )).scalars().all()
     if not conv:
         return HTMLResponse("Conversation not found", status_code=404)
 
-    msg_html = ""
-    for m in msgs:
-        who = "Customer" if m.direction == "inbound" else ("AI" if m.sent_by_ai else "Agent")
-        msg_html += f"<div style='margin:6px 0'><span style='color:#666'>{to_ist(m.ts_utc)}</span> <b>{who}:</b> {m.text}</div>"
-
-    assigned = conv.assigned_agent.name if conv.assigned_agent else "Unassigned"
-
-    return HTMLResponse(f"""
-    <html><body style="font-family:Arial;padding:16px;max-width:900px">
-    <a href="/inbox">← Back</a>
-    <h2>Chat: {conv.wa_id} {(conv.customer_name or "")}</h2>
-    <p>Status: <b>{conv.status}</b> | Mode: <b>{conv.mode}</b> | Assigned: <b>{assigned}</b></p>
-
-    <form method="post" action="/api/conversations/{conv.id}/assign">
-      <button>Assign to me</button>
-    </form>
-
-    <form method="post" action="/api/conversations/{conv.id}/mode" style="margin-top:8px">
-      <input type="hidden" name="mode" value="human"/>
-      <button>Handoff to Human</button>
-    </form>
-
-    <form method="post" action="/api/conversations/{conv.id}/mode" style="margin-top:8px">
-      <input type="hidden" name="mode" value="ai"/>
-      <button>Return to AI</button>
-    </form>
-
-    <hr/>
-    <div style="background:#f6f6f6;padding:12px;border-radius:8px">{msg_html}</div>
-
-    <hr/>
-    <h3>Reply (Agent)</h3>
-    <form method="post" action="/api/conversations/{conv.id}/reply">
-      <textarea name="text" style="width:100%;height:90px;padding:8px"></textarea><br/>
-      <button style="margin-top:8px;padding:10px 14px">Send</button>
-    </form>
-
-    </body></html>
-    """)
+    return HTMLResponse(CHAT_TPL.render(conv=conv, msgs=msgs))
 
 # ========== INBOX ACTIONS ==========
 @app.post("/api/conversations/{conv_id}/assign")
-def assign_to_me(request: Request, conv_id: int):
-    agent = require_login(request)
+async def assign_to_me(conv_id: int, agent: Optional[CurrentAgent] = Depends(require_login), db: AsyncSession = Depends(get_db)):
     if not agent:
         return RedirectResponse("/login", status_code=302)
 
-    db = SessionLocal()
-    conv = db.query(Conversation).filter(Conversation.id == conv_id).first()
+    conv = await db.get(Conversation, conv_id)
     if conv:
         conv.assigned_agent_id = agent.id
         conv.mode = "human"  # assignment implies human takeover
-        db.commit()
-    db.close()
+        await db.commit()
     return RedirectResponse(f"/inbox/chat/{conv_id}", status_code=302)
 
 @app.post("/api/conversations/{conv_id}/mode")
-def set_mode(request: Request, conv_id: int, mode: str = Form(...)):
-    agent = require_login(request)
+async def set_mode(conv_id: int, mode: str = Form(...), agent: Optional[CurrentAgent] = Depends(require_login), db: AsyncSession = Depends(get_db)):
     if not agent:
         return RedirectResponse("/login", status_code=302)
 
     if mode not in ("ai", "human"):
         return HTMLResponse("Invalid mode", status_code=400)
 
-    db = SessionLocal()
-    conv = db.query(Conversation).filter(Conversation.id == conv_id).first()
+    conv = await db.get(Conversation, conv_id)
     if conv:
         conv.mode = mode
-        db.commit()
-    db.close()
+        await db.commit()
     return RedirectResponse(f"/inbox/chat/{conv_id}", status_code=302)
 
 @app.post("/api/conversations/{conv_id}/reply")
-def agent_reply(request: Request, conv_id: int, text: str = Form(...)):
-    agent = require_login(request)
+async def agent_reply(conv_id: int, text: str = Form(...), agent: Optional[CurrentAgent] = Depends(require_login), db: AsyncSession = Depends(get_db)):
     if not agent:
         return RedirectResponse("/login", status_code=302)
 
-    db = SessionLocal()
-    conv = db.query(Conversation).filter(Conversation.id == conv_id).first()
+    conv = await db.get(Conversation, conv_id)
     if not conv:
-        db.close()
         return HTMLResponse("Conversation not found", status_code=404)
 
     # Basic concurrency rule: if assigned and not you, block
     if conv.assigned_agent_id and conv.assigned_agent_id != agent.id and agent.role != "admin":
-        db.close()
         return HTMLResponse("This chat is assigned to another agent.", status_code=403)
 
     conv.mode = "human"  # sending manual reply implies human mode
     conv.assigned_agent_id = conv.assigned_agent_id or agent.id
 
-    status_code, resp_text = wa_send_text(conv.wa_id, text)
+    status_code, resp_text = await wa_send_text(conv.wa_id, text)
+    now = datetime.now(timezone.utc)
 
-    save_message(
+    await save_message(
         db,
         conv.id,
         "outbound",
@@ -537,10 +776,9 @@ def agent_reply(request: Request, conv_id: int, text: str = Form(...)):
         message_id=None,
         sent_by_agent_id=agent.id,
         sent_by_ai=0,
-        ts=datetime.now(timezone.utc),
+        ts=now,
     )
-    conv.last_message_at = datetime.now(timezone.utc)
-    db.commit()
-    db.close()
+    conv.last_message_at = now
+    await db.commit()
 
     return RedirectResponse(f"/inbox/chat/{conv_id}", status_code=302)